@@ -12,16 +12,123 @@ args for substituting place holders in the defined prompt.
 """
 
 import asyncio
+import atexit
+import functools
 import json
 import logging
 import os
 import argparse
-from typing import Any, Dict, Final, List, Optional
-from mentat import Mentat  # type: ignore
+import re
+from typing import Any, Dict, Final, List, Optional, Tuple
 import sys
 
-# Possibly switch to lxml.etree in the future to support schema validation
-import xml.etree.ElementTree as ET
+# Log with %-style arguments: messages only get formatted if they are emitted
+log = logging.getLogger(__name__)
+
+# lxml parses in C and enables schema validation in the future.
+# Without it we use ElementTree, which CPython backs with its C accelerator
+try:
+    from lxml import etree as ET  # type: ignore
+
+    HAS_LXML = True
+except ImportError:
+    import xml.etree.ElementTree as ET  # type: ignore
+
+    HAS_LXML = False
+
+
+# Top-level nodes of a command definition that we actually use
+USED_TAGS: Final = frozenset({"prompt", "argument", "variable", "context"})
+
+# Size of the chunks we read from command definition files. Typical files
+# are much smaller and get read at once
+CHUNK_SIZE: Final = 65536
+
+
+# Create a streaming parser that reports when elements start and end.
+# We always get the C implementation: lxml's or ElementTree's accelerator.
+# Such a parser can only parse a single document, so get a new one each time
+def make_parser() -> Any:
+    events = ("start", "end")
+    if HAS_LXML:
+        return ET.XMLPullParser(events, remove_blank_text=True, huge_tree=False)
+    return ET.XMLPullParser(events)
+
+
+# Parse an XML file and return its root element. The result is cached by
+# path and modification time, so running a command again reuses the tree as
+# long as the file didn't change. The tree is shared: treat it as read-only!
+# Top-level nodes we don't use get cleared as soon as they are parsed so that
+# large files (e.g. with embedded documentation) don't stay in memory
+@functools.lru_cache(maxsize=64)
+def parse_cached(file_path: str, mtime: int) -> Any:
+    parser = make_parser()
+    root: Any = None
+    depth = 0
+    unused: List[Any] = []
+
+    def process_events() -> None:
+        nonlocal root, depth
+        for event, element in parser.read_events():
+            if event == "start":
+                if root is None:
+                    root = element
+                depth += 1
+                continue
+            depth -= 1
+            if depth == 1 and element.tag not in USED_TAGS:
+                # Removing it from the tree now could confuse the parser
+                element.clear()
+                unused.append(element)
+
+    with open(file_path, "rb", buffering=CHUNK_SIZE) as file:
+        while chunk := file.read(CHUNK_SIZE):
+            parser.feed(chunk)
+            process_events()
+    parser.close()
+    process_events()
+
+    for element in unused:
+        root.remove(element)
+    return root
+
+
+# Compile a regular expression matching any of the given placeholders.
+# Longer placeholders come first so that e.g. TEST_CLASS_NAME wins over CLASS_NAME
+@functools.lru_cache(maxsize=64)
+def placeholder_pattern(placeholders: Tuple[str, ...]) -> re.Pattern:
+    ordered = sorted(placeholders, key=len, reverse=True)
+    return re.compile("|".join(re.escape(placeholder) for placeholder in ordered))
+
+
+# The Mentat SDK takes a while to import and we only need it to actually run
+# a prompt. So it is imported on first use, see get_mentat()
+Mentat: Any = None
+
+
+def get_mentat() -> Any:
+    global Mentat
+    if Mentat is None:
+        from mentat import Mentat  # type: ignore
+    return Mentat
+
+
+# Event loop shared by all Assistant.run_sync() calls
+event_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+# Replace the placeholders in a prompt with their values, given as tuple of
+# (placeholder, value) pairs. Cached, so that rendering the same prompt with
+# the same values again (e.g. in batch runs) is just a lookup
+@functools.lru_cache(maxsize=128)
+def render_prompt(prompt: str, values: Tuple[Tuple[str, str], ...]) -> str:
+    if not values:
+        return prompt
+    replacements = dict(values)
+    # Replace all placeholders in one pass. Replacing them one after the
+    # other would also replace placeholders within already inserted values
+    pattern = placeholder_pattern(tuple(replacements))
+    return pattern.sub(lambda match: replacements[match.group(0)], prompt)
 
 
 class Assistant:
@@ -37,63 +144,149 @@ class Assistant:
         self.promptsdir: Final[str] = promptsdir
         self.composer_json: Final[str] = composer_json
         self.xml_root: Optional[Any] = None
+        # <argument>, <variable> and <include> nodes, collected by parse_xml().
+        # includes is None if there is no <context> node
+        self.arguments: List[Any] = []
+        self.variables: List[Any] = []
+        self.includes: Optional[List[Any]] = None
+        # The prompt as given in the XML and the ids of the arguments and
+        # variables appearing in it, set by parse_xml()
+        self.raw_prompt: str = ""
+        self.placeholders: List[str] = []
         # Map of search -> replace entries for the prompt
         self.replacements: Dict[str, str] = {}
 
-    async def run(self) -> None:
-        logging.info(f"Starting to run {self.command}")
+    # Run the command with Mentat. If a client is given, it must already be
+    # started and stays running afterwards, so it can be reused for more commands.
+    # The context of this command is NOT added to a given client: the caller
+    # must have started it with get_context() included in its paths
+    # (run_many() takes care of that).
+    # Otherwise we start our own client with the context of this command.
+    async def run(self, client: Optional[Any] = None) -> None:
+        log.info("Starting to run %s", self.command)
         try:
-            self.parse_xml()
+            prompt, context = self.prepare()
         except RuntimeError as e:
-            logging.error(e)
+            log.error(e)
+            return
+
+        # Now let mentat do the work
+        log.info("Running Mentat now...")
+        if client is not None:
+            log.info("Using the given client. Not adding context: %s", context)
+            await client.call_mentat_auto_accept(prompt)
+        else:
+            client = get_mentat()(paths=context)
+            await client.startup()
+            await client.call_mentat_auto_accept(prompt)
+            await client.shutdown()
+        log.info("Done. Mentat finished its work.")
+
+    # Synchronous version of run() when using the assistant as a library.
+    # Unlike asyncio.run() this doesn't set up a new event loop for every call
+    def run_sync(self, client: Optional[Any] = None) -> None:
+        global event_loop
+        if event_loop is None or event_loop.is_closed():
+            event_loop = asyncio.new_event_loop()
+            atexit.register(event_loop.close)
+        event_loop.run_until_complete(self.run(client))
+
+    # Run several commands with a single Mentat client, so that we have to start
+    # it only once. The client gets the combined context of all commands.
+    # All missing arguments are asked for before Mentat starts.
+    @classmethod
+    async def run_many(cls, assistants: List["Assistant"]) -> None:
+        prompts: List[str] = []
+        context: List[str] = []
+        for assistant in assistants:
+            log.info("Preparing %s", assistant.command)
+            try:
+                prompt, paths = assistant.prepare()
+            except RuntimeError as e:
+                log.error(e)
+                continue
+            prompts.append(prompt)
+            context.extend(paths)
+        if not prompts:
             return
 
+        log.info("Running Mentat now with %d prompts...", len(prompts))
+        client = get_mentat()(paths=canonical_paths(context))
+        await client.startup()
+        for prompt in prompts:
+            await client.call_mentat_auto_accept(prompt)
+        await client.shutdown()
+        log.info("Done. Mentat finished its work.")
+
+    # Parse the command definition, process all arguments and variables
+    # Returns the prompt and the list of files to include as context
+    # Raises RuntimeError if the command definition couldn't be loaded
+    def prepare(self) -> Tuple[str, List[str]]:
+        self.parse_xml()
         self.process_arguments()
         self.resolve_variables()
 
         prompt = self.get_prompt()
-        logging.info(prompt)
+        log.info(prompt)
         context = self.get_context()
-        logging.info(f"Files to include as context: {context}")
-
-        # Now let mentat do the work
-        logging.info("Running Mentat now...")
-        client = Mentat(paths=context)
-        await client.startup()
-        await client.call_mentat_auto_accept(prompt)
-        await client.shutdown()
-        logging.info("Done. Mentat finished its work.")
+        log.info("Files to include as context: %s", context)
+        return prompt, context
 
     # Open our command file (XML) and parse it
     def parse_xml(self) -> None:
         assert self.xml_root is None
         # Open and parse XML file
         file_path = os.path.join(self.promptsdir, f"{self.command}.xml")
+        # We need to stat the file for the cache anyway. That also tells us
+        # cheaply whether it exists before we go anywhere near the parser
         try:
-            tree = ET.parse(file_path)
-            self.xml_root = tree.getroot()
+            mtime = os.stat(file_path).st_mtime_ns
+        except FileNotFoundError:
+            raise RuntimeError(
+                f"Command definition file not found: {file_path}"
+            ) from None
+        try:
+            self.xml_root = parse_cached(file_path, mtime)
         except ET.ParseError as e:
             raise RuntimeError(f"Error parsing XML: {e}")
         except FileNotFoundError:
+            # The file got deleted right after we checked it
             raise RuntimeError(f"Command definition file not found: {file_path}")
 
+        # Collect the nodes we need later so that we walk the tree only once
+        self.arguments = self.xml_root.findall("argument")
+        self.variables = self.xml_root.findall("variable")
+        context_node = self.xml_root.find("context")
+        if context_node is not None:
+            self.includes = context_node.findall("include")
+
+        # Find out which placeholders the prompt uses, so that get_prompt()
+        # doesn't need to look for the others
+        self.raw_prompt = self.xml_root.find("prompt").text.strip()
+        self.placeholders = [
+            node.get("id")
+            for node in self.arguments + self.variables
+            if node.get("id") in self.raw_prompt
+        ]
+
     # Process all arguments. Ask the user now for values of arguments
     # missing in the command line.
     # Saves the results in self.replacements
     def process_arguments(self) -> None:
         assert self.xml_root is not None
         # Parse the remaining (previously "unknown") arguments
-        parser = argparse.ArgumentParser()
-        for argument in self.xml_root.findall("argument"):
-            parser.add_argument(f"--{argument.get('alias')}")
-        cmd_args = parser.parse_args(self.args)
+        options = parse_options(self.args)
+        aliases = {argument.get("alias") for argument in self.arguments}
+        for name in options:
+            if name not in aliases:
+                log.warning("Ignoring unknown argument --%s", name)
 
         # Go through all arguments and ask the user for missing arguments
-        for argument in self.xml_root.findall("argument"):
+        for argument in self.arguments:
             alias = argument.get("alias")
-            value = getattr(cmd_args, alias.replace("-", "_"), None)
+            value = options.get(alias)
             if value:
-                logging.info(f"Replacing {argument.get('id')} with {value}")
+                log.info("Replacing %s with %s", argument.get("id"), value)
             else:
                 question = argument.get("question")
                 value = input(f"Missing --{alias}. {question}\n")
@@ -103,140 +296,272 @@ class Assistant:
     def resolve_variables(self) -> None:
         assert self.xml_root is not None
         converter = Converter(composer_json=self.composer_json)
-        for var in self.xml_root.findall("variable"):
+        for var in self.variables:
             arg = var.get("argument")
             if arg not in self.replacements:
-                logging.warning(f"Missing argument {arg} for variable {var}")
+                log.warning("Missing argument %s for variable %s", arg, var)
                 continue
             value = converter.convert(var.get("converter"), self.replacements[arg])
             if value is not None:
-                logging.info(f"Replacing {var.get('id')} with {value}")
+                log.info("Replacing %s with %s", var.get("id"), value)
                 self.replacements[var.get("id")] = value
             else:
-                logging.warning(f"Couldn't compute value of variable {var.get('id')}")
+                log.warning("Couldn't compute value of variable %s", var.get("id"))
 
     # Get prompt from XML and replace all placeholders with their values
-    # by going through self.replacements
+    # from self.replacements
     def get_prompt(self) -> str:
         assert self.xml_root is not None
-        prompt = self.xml_root.find("prompt").text.strip()
-        logging.info(f"Raw prompt: {prompt}")
-        for search, replace in self.replacements.items():
-            prompt = prompt.replace(search, replace)
-
-        return prompt
+        prompt = self.raw_prompt
+        log.info("Raw prompt: %s", prompt)
+        values = tuple(
+            (p, self.replacements[p])
+            for p in self.placeholders
+            if p in self.replacements
+        )
+        return render_prompt(prompt, values)
 
     # Parse XML to get the list of files / directories that should get included
     # as context
     def get_context(self) -> List[str]:
         assert self.xml_root is not None
         ret: List[str] = []
-        context_node = self.xml_root.find("context")
-        if context_node is None:
-            logging.info(f"No <context> node found in {self.command}.xml")
+        if self.includes is None:
+            log.info("No <context> node found in %s.xml", self.command)
             return ret
-        for include in context_node.findall("include"):
+        for include in self.includes:
             path = include.get("path")
             if path.startswith("$"):
                 if path[1:] in self.replacements:
                     ret.append(self.replacements[path[1:]])
                 else:
-                    logging.warning(
-                        f"Couldn't determine value of {path}. " "Not adding to context."
+                    log.warning(
+                        "Couldn't determine value of %s. Not adding to context.", path
                     )
             else:
                 ret.append(path)
-        return ret
+        return canonical_paths(ret)
+
+
+# Resolve the given paths and remove duplicates as well as paths inside of
+# other given directories, so that Mentat doesn't include any file twice.
+# The order of the remaining paths is kept
+def canonical_paths(paths: List[str]) -> List[str]:
+    # A dict keeps the insertion order, so we use it as an ordered set
+    resolved: Dict[str, None] = dict.fromkeys(os.path.realpath(path) for path in paths)
+    ret: List[str] = []
+    for path in resolved:
+        # Go up the directory tree until we reach the root or a path we already have
+        child, parent = path, os.path.dirname(path)
+        while parent != child and parent not in resolved:
+            child, parent = parent, os.path.dirname(parent)
+        if parent == child:
+            ret.append(path)
+    return ret
+
+
+# Parse command arguments of the form "--name value" or "--name=value"
+# Returns the map of name -> value
+# That's all we need, so we avoid the overhead of setting up argparse
+def parse_options(args: List[str]) -> Dict[str, str]:
+    options: Dict[str, str] = {}
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        i += 1
+        if not arg.startswith("--"):
+            log.warning("Ignoring unexpected argument %s", arg)
+            continue
+        name, equals, value = arg[2:].partition("=")
+        # Without "=" the value is the next argument, if it isn't an option
+        if not equals and i < len(args) and not args[i].startswith("--"):
+            value = args[i]
+            i += 1
+        options[name] = value
+    return options
 
 
 # Class for converting arguments
 # Currently we have one converter for determining the file path of a PHP class path
 class Converter:
-    def __init__(self, composer_json: str = "composer.json"):
+    # If composer_data is given, it is used instead of reading composer_json
+    def __init__(
+        self,
+        composer_json: str = "composer.json",
+        composer_data: Optional[Dict[str, Any]] = None,
+    ):
         self.composer_json = composer_json
-        self.composer_data = None
+        if composer_data is not None:
+            self.composer_data = composer_data
+        # Cache of fqcn -> class path: composer.json won't change meanwhile
+        self.class_paths: Dict[str, Optional[str]] = {}
+
+    # Return a Converter with composer_json already loaded. Pass its
+    # composer_data on to further Converters so that the file is read only once
+    @classmethod
+    def from_path(cls, composer_json: str) -> "Converter":
+        converter = cls(composer_json)
+        converter.composer_data = converter.load_composer_json()
+        return converter
+
+    # Content of composer.json. Only loaded when a converter needs it
+    @functools.cached_property
+    def composer_data(self) -> Optional[Dict[str, Any]]:
+        return self.load_composer_json()
+
+    def load_composer_json(self) -> Optional[Dict[str, Any]]:
         try:
             with open(self.composer_json, "r") as file:
-                self.composer_data = json.load(file)
+                return json.load(file)
         except FileNotFoundError:
-            logging.warning(
-                f"{self.composer_json} not found. Can't resolve class paths."
-            )
+            log.warning("%s not found. Can't resolve class paths.", self.composer_json)
+            return None
 
     def convert(self, converter: str, argument: str) -> Optional[str]:
         # As we currently have only on converter, let's keep it simple:
         if converter == "resolveClassPath":
             return self.resolve_class_path(argument)
-        logging.warning(f"Unknown converter {converter}. ")
+        log.warning("Unknown converter %s", converter)
         return None
 
+    # Map of namespace prefix -> base directory from composer.json
+    # A base directory may also be a list of directories
+    @functools.cached_property
+    def namespace_map(self) -> Dict[str, Any]:
+        if self.composer_data is None:
+            return {}
+        # Gather namespace information from composer.json
+        # (autoload wins over autoload-dev for identical prefixes)
+        namespace_map: Dict[str, Any] = {}
+        namespace_map.update(
+            self.composer_data.get("autoload-dev", {}).get("psr-4", {})
+        )
+        namespace_map.update(self.composer_data.get("autoload", {}).get("psr-4", {}))
+        return namespace_map
+
+    # Character trie of all namespace prefixes for the longest-prefix lookup.
+    # Every node is a dict of next character -> child node. A node where a
+    # prefix ends stores the list of its base directories under the key ""
+    # (which can never clash with a single character). Base directories
+    # already use "/"
+    @functools.cached_property
+    def namespace_trie(self) -> Dict[str, Any]:
+        trie: Dict[str, Any] = {}
+        for prefix, base_dirs in self.namespace_map.items():
+            if isinstance(base_dirs, str):
+                base_dirs = [base_dirs]
+            node = trie
+            for char in prefix:
+                node = node.setdefault(char, {})
+            node[""] = [base_dir.replace("\\", "/") for base_dir in base_dirs]
+        return trie
+
     # Return the file path for the given fully-qualified class name (fqcn)
     # Returns None if we can't find matching namespace information in composer.json
     # See https://www.php-fig.org/psr/psr-4/
     # and https://getcomposer.org/doc/04-schema.md#psr-4
     def resolve_class_path(self, fqcn: str) -> Optional[str]:
+        if fqcn not in self.class_paths:
+            self.class_paths[fqcn] = self.lookup_class_path(fqcn)
+        return self.class_paths[fqcn]
+
+    # Uncached implementation of resolve_class_path()
+    def lookup_class_path(self, fqcn: str) -> Optional[str]:
         if self.composer_data is None:
             return None
-        # Gather namespace information from composer.json
-        namespace_map: Dict[str, str] = {}
-        if (
-            "autoload-dev" in self.composer_data
-            and "psr-4" in self.composer_data["autoload-dev"]
-        ):
-            namespace_map = namespace_map | self.composer_data["autoload-dev"]["psr-4"]
-        else:
-            logging.info("Didn't find autoload-dev section in composer.json")
-        if (
-            "autoload" in self.composer_data
-            and "psr-4" in self.composer_data["autoload"]
-        ):
-            namespace_map = namespace_map | self.composer_data["autoload"]["psr-4"]
-        else:
-            logging.info("Didn't find autoload section in composer.json")
 
-        # Find the most specific (longest) matching namespace prefix
+        # Walk down the trie and remember the most specific (longest) prefix
+        class_name = fqcn[1:]
+        node: Dict[str, Any] = self.namespace_trie
         match_length: int = -1  # match_length of 0 is possible for ""
+        base_dirs: List[str] = []
+        for depth in range(len(class_name) + 1):
+            if "" in node:
+                match_length = depth
+                base_dirs = node[""]
+            if depth == len(class_name) or class_name[depth] not in node:
+                break
+            node = node[class_name[depth]]
+
         class_path: Optional[str] = None
-        for prefix, base_dir in namespace_map.items():
-            if fqcn[1:].startswith(prefix) and (len(prefix) > match_length):
-                match_length = len(prefix)
-                class_path = f"{base_dir}{fqcn[1 + len(prefix):]}.php".replace(
-                    "\\", "/"
-                )
-
-        logging.info(f"Resolving class path for {fqcn}: {class_path}")
+        if match_length >= 0 and base_dirs:
+            suffix = class_name[match_length:].replace("\\", "/")
+            candidates = [f"{base_dir}{suffix}.php" for base_dir in base_dirs]
+            # With several base directories take the one where the file exists.
+            # If there is none (e.g. for a class yet to be written), use the first
+            class_path = next(
+                (path for path in candidates if os.path.isfile(path)), candidates[0]
+            )
+
+        log.info("Resolving class path for %s: %s", fqcn, class_path)
         return class_path
 
 
-# Parse the given arguments and return accordingly initialized Assistant
-def parse_args(sys_args) -> Assistant:
+# Options of the assistant itself. All other options belong to the command
+HELP_OPTIONS: Final = frozenset({"-h", "--help"})
+VERBOSE_OPTIONS: Final = frozenset({"-v", "--verbose"})
+PROMPTSDIR_OPTION: Final = "--promptsdir"
+
+
+# Argument parser for the assistant itself. We only use it for printing
+# help and usage errors, as parsing our few options directly is much cheaper
+def get_arg_parser() -> argparse.ArgumentParser:
     description = "Run pre-defined functions/prompts with mentat"
     parser = argparse.ArgumentParser(description=description)
     parser.add_argument("command", help="Name of the function / prompt")
     parser.add_argument(
-        "--promptsdir",
+        PROMPTSDIR_OPTION,
         default="prompts",
         help="Directory holding the command definition XML file(s)",
     )
     parser.add_argument("-v", "--verbose", action="store_true")
+    return parser
 
+
+# Parse the given arguments and return accordingly initialized Assistant
+def parse_args(sys_args) -> Assistant:
+    command: Optional[str] = None
+    promptsdir = "prompts"
+    verbose = False
     # The command may have more arguments we don't know yet.
     # An alternative would be to parse the available XML files now and add
-    # their argument structure via parser.add_subparsers().
+    # their argument structure via argparse subparsers.
     # However that would be incompatible with providing a --promptsdir option
-    args, more_args = parser.parse_known_args(sys_args)
+    more_args: List[str] = []
+    i = 0
+    while i < len(sys_args):
+        arg = sys_args[i]
+        i += 1
+        if arg in VERBOSE_OPTIONS:
+            verbose = True
+        elif arg in HELP_OPTIONS:
+            get_arg_parser().print_help()
+            sys.exit(0)
+        elif arg == PROMPTSDIR_OPTION:
+            if i == len(sys_args):
+                get_arg_parser().error(f"argument {arg}: expected one argument")
+            promptsdir = sys_args[i]
+            i += 1
+        elif arg.startswith(f"{PROMPTSDIR_OPTION}="):
+            promptsdir = arg.partition("=")[2]
+        elif command is None and not arg.startswith("-"):
+            command = arg
+        else:
+            more_args.append(arg)
+    if command is None:
+        get_arg_parser().error("the following arguments are required: command")
 
     # Set up logging
     root = logging.getLogger()
     root.setLevel(logging.WARNING)
-    if args.verbose:
+    if verbose:
         root.setLevel(logging.INFO)
     sh = logging.StreamHandler(sys.stdout)
     fformatter = logging.Formatter("%(levelname)s: %(message)s")
     sh.setFormatter(fformatter)
     root.addHandler(sh)
 
-    return Assistant(args.command, more_args, promptsdir=args.promptsdir)
+    return Assistant(command, more_args, promptsdir=promptsdir)
 
 
 if __name__ == "__main__":
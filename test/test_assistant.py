@@ -1,11 +1,33 @@
-import asyncio
+import io
+import os
+import tempfile
 from typing import Dict
 import unittest
-from unittest.mock import patch, AsyncMock
-from assistant import Assistant, Converter, parse_args
+from unittest.mock import patch, AsyncMock, MagicMock
+from assistant import (
+    Assistant,
+    Converter,
+    canonical_paths,
+    parse_args,
+    parse_options,
+    render_prompt,
+)
 
+# Methods of the Mentat client that the assistant awaits
+MENTAT_ASYNC_METHODS = ("startup", "call_mentat_auto_accept", "shutdown")
 
-class TestAssistant(unittest.TestCase):
+
+# Create a mocked Mentat client. Only the methods we await are AsyncMocks,
+# which are more expensive to create than plain MagicMocks
+def mock_mentat_client():
+    client = MagicMock()
+    for name in MENTAT_ASYNC_METHODS:
+        setattr(client, name, AsyncMock())
+    return client
+
+
+# Assistants used by the tests of TestAssistant and TestAssistantAsync
+class AssistantFixtures:
     def setUp(self):
         # Use this to see logging messages while running tests
         # logging.basicConfig(level=logging.INFO)
@@ -26,6 +48,8 @@ class TestAssistant(unittest.TestCase):
             composer_json="test/composer.json",
         )
 
+
+class TestAssistant(AssistantFixtures, unittest.TestCase):
     def test_parse_xml(self):
         # Test normal behavior
         self.assistant.parse_xml()
@@ -33,6 +57,9 @@ class TestAssistant(unittest.TestCase):
         self.assertIsNotNone(self.assistant.xml_root.find("argument"))
         self.assertIsNotNone(self.assistant.xml_root.find("context"))
         self.assertIsNone(self.assistant.xml_root.find("notexisting"))
+        # Nodes we don't use aren't kept in memory
+        self.assertIsNone(self.assistant.xml_root.find("notes"))
+        self.assertListEqual(self.assistant.placeholders, ["CLASS_NAME", "METHOD_NAME"])
 
         # Test with an invalid XML structure
         assistant = Assistant("test-invalid-structure", [], promptsdir="test")
@@ -46,6 +73,29 @@ class TestAssistant(unittest.TestCase):
             assistant.parse_xml()
         self.assertIn("Command definition file not found", str(error.exception))
 
+        # Parsing the same unchanged file again reuses the cached tree
+        assistant = Assistant("test-arguments-and-context", [], promptsdir="test")
+        assistant.parse_xml()
+        self.assertIs(assistant.xml_root, self.assistant.xml_root)
+
+    def test_parse_xml_after_change(self):
+        with tempfile.TemporaryDirectory() as promptsdir:
+            file_path = os.path.join(promptsdir, "changing.xml")
+            with open(file_path, "w") as file:
+                file.write("<function><prompt>First</prompt></function>")
+            assistant = Assistant("changing", [], promptsdir=promptsdir)
+            assistant.parse_xml()
+            self.assertEqual(assistant.raw_prompt, "First")
+
+            # A modified file is parsed again
+            with open(file_path, "w") as file:
+                file.write("<function><prompt>Second</prompt></function>")
+            mtime = os.stat(file_path).st_mtime_ns + 1_000_000_000
+            os.utime(file_path, ns=(mtime, mtime))
+            assistant = Assistant("changing", [], promptsdir=promptsdir)
+            assistant.parse_xml()
+            self.assertEqual(assistant.raw_prompt, "Second")
+
     def test_get_prompt(self):
         expected_prompt = "Test method `start` in class `TestClass`."
         self.assistant.parse_xml()
@@ -54,33 +104,83 @@ class TestAssistant(unittest.TestCase):
 
         # giving arguments in the form --class=TestClass
         # should give the same result as giving it as --class TestClass
-        self.assistant.args = ["--class=TestClass", "--method=start"]
-        self.assertEqual(self.assistant.get_prompt(), expected_prompt)
+        assistant = Assistant(
+            "test-arguments-and-context",
+            ["--class=TestClass", "--method=start"],
+            promptsdir="test",
+        )
+        assistant.parse_xml()
+        assistant.process_arguments()
+        hits = render_prompt.cache_info().hits
+        self.assertEqual(assistant.get_prompt(), expected_prompt)
+        # Same prompt with same values: comes from the cache
+        self.assertEqual(render_prompt.cache_info().hits, hits + 1)
+
+        # Placeholders that contain other placeholders (CLASS_NAME is part of
+        # TEST_CLASS_NAME) must be replaced as a whole
+        self.assistant2.parse_xml()
+        self.assistant2.process_arguments()
+        self.assistant2.resolve_variables()
+        self.assertEqual(
+            self.assistant2.get_prompt(),
+            "Test class `\\Assistant\\Random`. Save the resulting "
+            "`\\Assistant\\Test\\RandomTest` to "
+            "`src/Assistant/Test/RandomTest.php`",
+        )
 
     def test_get_context(self):
         # Test normal behavior
         self.assistant.parse_xml()
-        self.assertListEqual(["tests", "src"], self.assistant.get_context())
+        self.assertListEqual(
+            [os.path.realpath("tests"), os.path.realpath("src")],
+            self.assistant.get_context(),
+        )
 
         # Test with missing <context> node
-        self.assistant.xml_root.remove(self.assistant.xml_root.find("context"))
-        assert len(self.assistant.get_context()) == 0
+        assistant = Assistant("test-no-context", [], promptsdir="test")
+        assistant.parse_xml()
+        assert len(assistant.get_context()) == 0
 
         # Test variable substitution
         self.assistant2.parse_xml()
         self.assistant2.process_arguments()
         with self.assertLogs(level="WARNING"):
-            self.assertListEqual(["tests"], self.assistant2.get_context())
+            self.assertListEqual(
+                [os.path.realpath("tests")], self.assistant2.get_context()
+            )
         self.assistant2.resolve_variables()
         self.assertListEqual(
-            ["tests", "src/Assistant/Random.php"], self.assistant2.get_context()
+            [os.path.realpath("tests"), os.path.realpath("src/Assistant/Random.php")],
+            self.assistant2.get_context(),
+        )
+
+    def test_canonical_paths(self):
+        # Duplicates are removed and the order is kept
+        self.assertListEqual(
+            canonical_paths(["src/Test.php", "./tests", "tests/", "src/Test.php"]),
+            [os.path.realpath("src/Test.php"), os.path.realpath("tests")],
+        )
+        # Paths inside of other directories are removed
+        self.assertListEqual(
+            canonical_paths(["src/Test.php", "src/../src"]),
+            [os.path.realpath("src")],
         )
+        self.assertListEqual(canonical_paths(["src", "tests", "/"]), ["/"])
 
     @patch("assistant.Mentat")
-    def test_run(self, mock_mentat):
-        mock_mentat.return_value = AsyncMock()
-        with self.assertLogs(level="WARNING"):
-            asyncio.run(self.assistant.run())
+    def test_run_sync(self, mock_mentat):
+        mock_mentat.return_value = mock_mentat_client()
+        self.assistant.run_sync()
+        self.assistant2.run_sync()
+        self.assertEqual(mock_mentat.return_value.call_mentat_auto_accept.call_count, 2)
+
+
+# Tests of the async methods, run in an event loop managed by unittest
+class TestAssistantAsync(AssistantFixtures, unittest.IsolatedAsyncioTestCase):
+    @patch("assistant.Mentat")
+    async def test_run(self, mock_mentat):
+        mock_mentat.return_value = mock_mentat_client()
+        await self.assistant.run()
         mock_mentat.assert_called_once()
         mock_mentat.return_value.startup.assert_called_once()
         mock_mentat.return_value.call_mentat_auto_accept.assert_called_with(
@@ -88,6 +188,38 @@ class TestAssistant(unittest.TestCase):
         )
         mock_mentat.return_value.shutdown.assert_called_once()
 
+        # Reuse a client that is already running
+        mock_mentat.reset_mock()
+        client = mock_mentat_client()
+        assistant = Assistant("test-no-context", ["--class", "Test"], promptsdir="test")
+        with self.assertLogs(level="INFO") as logs:
+            await assistant.run(client)
+        self.assertTrue(any("Not adding context" in line for line in logs.output))
+        mock_mentat.assert_not_called()
+        client.startup.assert_not_called()
+        client.call_mentat_auto_accept.assert_called_with("Explain class `Test`.")
+        client.shutdown.assert_not_called()
+
+    @patch("assistant.Mentat")
+    async def test_run_many(self, mock_mentat):
+        mock_mentat.return_value = mock_mentat_client()
+        with self.assertLogs(level="ERROR"):
+            await Assistant.run_many(
+                [
+                    self.assistant,
+                    Assistant("not-existing", [], promptsdir="test"),
+                    self.assistant2,
+                ]
+            )
+        # One client with the context of all commands
+        # (src/Assistant/Random.php is already included with src)
+        mock_mentat.assert_called_once_with(
+            paths=[os.path.realpath("tests"), os.path.realpath("src")]
+        )
+        mock_mentat.return_value.startup.assert_called_once()
+        self.assertEqual(mock_mentat.return_value.call_mentat_auto_accept.call_count, 2)
+        mock_mentat.return_value.shutdown.assert_called_once()
+
 
 class TestMain(unittest.TestCase):
     def test_parse_args(self):
@@ -116,31 +248,93 @@ class TestMain(unittest.TestCase):
         )
         self.assertEqual(assistant.promptsdir, "test_prompts")
 
+        assistant = parse_args(["--promptsdir=test_prompts", "test", "--class=A"])
+        self.assertEqual(assistant.command, "test")
+        self.assertListEqual(assistant.args, ["--class=A"])
+        self.assertEqual(assistant.promptsdir, "test_prompts")
+
+        # Missing command
+        with patch("sys.stderr", new_callable=io.StringIO) as stderr:
+            with self.assertRaises(SystemExit):
+                parse_args(["-v"])
+        self.assertIn("required: command", stderr.getvalue())
+
+    def test_parse_options(self):
+        self.assertDictEqual(
+            parse_options(["--class", "TestClass", "--test-class=Test=Class"]),
+            {"class": "TestClass", "test-class": "Test=Class"},
+        )
+        # An option without value is treated as missing
+        self.assertDictEqual(
+            parse_options(["--class", "--method", "start"]),
+            {"class": "", "method": "start"},
+        )
+        with self.assertLogs(level="WARNING"):
+            self.assertDictEqual(parse_options(["TestClass"]), {})
+        # An explicitly empty value doesn't take the next argument
+        with self.assertLogs(level="WARNING"):
+            self.assertDictEqual(parse_options(["--class=", "Test"]), {"class": ""})
+
 
 class TestConverter(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # Read test/composer.json only once for all tests
+        cls.composer_data = Converter.from_path("test/composer.json").composer_data
+
+    def test_from_path(self):
+        self.assertIsNotNone(self.composer_data)
+        with self.assertLogs(level="WARNING"):
+            converter = Converter.from_path("not_existing.json")
+        self.assertIsNone(converter.composer_data)
+
     def test_convert(self):
+        converter = Converter(composer_json="not_existing.json")
         with self.assertLogs(level="WARNING"):
-            converter = Converter(composer_json="not_existing.json")
-        self.assertIsNone(converter.convert("resolveClassPath", "test"))
+            self.assertIsNone(converter.convert("resolveClassPath", "test"))
         with self.assertLogs(level="WARNING"):
             self.assertIsNone(converter.convert("unknown", "test"))
 
     def test_resolve_class_path(self):
-        converter = Converter(composer_json="test/composer.json")
+        converter = Converter(composer_data=self.composer_data)
         test_cases: Dict[str, str] = {
             "\\Acme\\Log\\Writer\\File_Writer": "./acme-log-writer/lib/File_Writer.php",
             "\\Aura\\Web\\Response\\Status": "/path/aura-web/src/Response/Status.php",
             "\\Aura\\Web\\Tests\\BaseTest": "/path/aura-web/tests/BaseTest.php",
             "\\Symfony\\Core\\Request": "./vendor/Symfony/Core/Request.php",
             "\\Zend\\Acl": "/usr/includes/Zend/Acl.php",
+            "\\Multi\\Dir\\Foo": "./multi-a/Foo.php",
             "\\Test\\Random": "src/Test/Random.php",
         }
         for fqcn, file_path in test_cases.items():
             self.assertEqual(converter.resolve_class_path(fqcn), file_path)
 
+        # With several base directories the one containing the class wins
+        with tempfile.TemporaryDirectory() as base_dir:
+            open(os.path.join(base_dir, "Existing.php"), "w").close()
+            converter2 = Converter(
+                composer_data={
+                    "autoload": {"psr-4": {"A\\": ["not-existing/", f"{base_dir}/"]}}
+                }
+            )
+            self.assertEqual(
+                converter2.resolve_class_path("\\A\\Existing"),
+                f"{base_dir}/Existing.php",
+            )
+            self.assertEqual(
+                converter2.resolve_class_path("\\A\\New"), "not-existing/New.php"
+            )
+
+        # Resolving the same class again uses the cached result
+        with self.assertNoLogs(level="INFO"):
+            self.assertEqual(
+                converter.resolve_class_path("\\Test\\Random"), "src/Test/Random.php"
+            )
+
+        # composer.json is only read when it's needed for the first time
+        converter = Converter(composer_json="not_existing.json")
         with self.assertLogs(level="WARNING"):
-            converter = Converter(composer_json="not_existing.json")
-        self.assertIsNone(converter.resolve_class_path("\\Test\\Random"))
+            self.assertIsNone(converter.resolve_class_path("\\Test\\Random"))
 
 
 if __name__ == "__main__":